@@ -1,10 +1,62 @@
+import asyncio
+import atexit
+import contextlib
+import functools
+import importlib.metadata
+import json
 import os
+import queue
+import re
+import shlex
+import shutil
+import signal
 import subprocess
-from typing import Optional, List
+import sys
+import tempfile
+import threading
+import time
+from typing import Any, Awaitable, Callable, Optional, List
 from fastmcp import FastMCP
 from pydantic import BaseModel, Field
 
-mcp = FastMCP("EnvMCP")
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+# Refuse duplicate tool names instead of letting one registration silently win
+mcp = FastMCP("EnvMCP", on_duplicate_tools="error")
+
+# Block sizes used when scanning files backwards for their last lines
+_TAIL_BLOCK_SIZE = 65536
+# Upper bound on bytes returned by a tail read, so files with few newlines stay cheap
+_TAIL_MAX_BYTES = 4 * 1024 * 1024
+_HISTORY_BLOCK_SIZE = 8192
+_HISTORY_WRITE_BUFFER = 4096
+# How long reads and shutdown wait for pending history writes
+_HISTORY_FLUSH_TIMEOUT = 1.0
+_HISTORY_COMMIT_TIMEOUT = 5.0
+
+# In-process cache for slow introspection probes: slot -> (timestamp, stamp, result)
+_CACHE: dict[str, tuple[float, str, Any]] = {}
+_CACHE_TTL = 30.0
+# Persisted probe results are only trusted for this many seconds
+_DISK_CACHE_MAX_AGE = 24 * 60 * 60
+
+# Probe subprocesses get a time limit and a minimal environment; HOME is kept
+# so npm still finds the user's config
+_SUBPROCESS_TIMEOUT = 5
+_SUBPROCESS_REAP_TIMEOUT = 1
+_MIN_ENV = {k: os.environ[k] for k in ("PATH", "HOME") if k in os.environ}
+
+# Basic validation to prevent some obvious disasters: ; && || | > < ` $(
+_FORBIDDEN_RE = re.compile(r"[;|<>`]|&&|\$\(")
+
+# The server's own interpreter never changes while it runs
+_PYTHON_VERSION = sys.version.split()[0]
+
+# Config files reported by introspect_runtime when present in the current directory
+_CONFIG_NAMES = (".env", "pyproject.toml", "package.json", "requirements.txt", "uv.lock")
 
 class ShellHistory(BaseModel):
     shell: str
@@ -13,8 +65,11 @@ class ShellHistory(BaseModel):
 
 class RuntimeHealth(BaseModel):
     python_version: str
+    python_executable: str
+    path_python: Optional[str] = None
     pip_packages: List[str]
-    npm_packages: List[str]
+    node_version: Optional[str] = None
+    npm_packages: List[str] = []
     current_directory: str
     env_files: List[str]
 
@@ -22,69 +77,418 @@ class CommandExecution(BaseModel):
     command: str = Field(..., description="The command to execute")
     dry_run: bool = Field(True, description="If True, only returns the command without executing it")
 
-@mcp.tool()
-def capture_terminal_state(lines: int = 10) -> str:
-    """Detects shell type and reads the last lines of history."""
+def _tail_lines(f, n: int, block_size: int = _TAIL_BLOCK_SIZE, max_bytes: int = _TAIL_MAX_BYTES) -> bytes:
+    """Returns the last n lines of a binary file object as raw bytes.
+
+    Reads fixed-size blocks backwards from the end of the file until enough
+    newlines have been seen, so only the tail is read. At most max_bytes are
+    read; if that limit is hit first, the oldest returned line is truncated.
+    Callers decode the result once.
+    """
+    if n <= 0:
+        return b""
+
+    f.seek(0, os.SEEK_END)
+    pos = f.tell()
+    # Blocks are read straight into their final place at the back of one
+    # buffer, so nothing is copied until the tail is sliced off at the end
+    buf = bytearray(min(pos, max_bytes))
+    view = memoryview(buf)
+    start = len(buf)
+    count = 0
+    # n + 1 newlines guarantees n complete lines even with a trailing newline
+    while start > 0 and count <= n:
+        block = min(block_size, start)
+        start -= block
+        pos -= block
+        f.seek(pos)
+        if f.readinto(view[start:start + block]) != block:
+            # The file shrank underneath us; keep only what was fully read
+            start += block
+            break
+        count += buf.count(b"\n", start, start + block)
+    tail = view[start:].tobytes()
+    view.release()
+
+    lines = tail.rsplit(b"\n", n + 1)
+    if lines and not lines[-1]:
+        lines.pop()
+    return b"\n".join(lines[-n:])
+
+def _detect_shell() -> tuple[str, str, Optional[str]]:
+    """Returns the home directory, shell and history file of the current environment."""
+    home = os.path.expanduser("~")
     shell = os.environ.get("SHELL", "unknown")
-    
+
     # Try to find history file
     hist_file = os.environ.get("HISTFILE")
     if not hist_file:
-        home = os.path.expanduser("~")
         if "zsh" in shell:
             hist_file = os.path.join(home, ".zsh_history")
         elif "bash" in shell:
             hist_file = os.path.join(home, ".bash_history")
-    
+    return home, shell, hist_file
+
+# These are effectively constant for the process lifetime, see refresh_env
+_HOME, _SHELL, _DEFAULT_HISTFILE = _detect_shell()
+
+class _HistoryWriter:
+    """Appends lines to history files from a background thread.
+
+    Writes are queued so callers never wait on disk I/O; the thread drains the
+    queue in batches and writes each file through a small buffer.
+    """
+
+    def __init__(self, maxsize: int = 1024):
+        self._queue: queue.Queue[tuple[str, str]] = queue.Queue(maxsize)
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def append(self, path: str, line: str) -> None:
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="history-writer", daemon=True)
+                self._thread.start()
+        self._queue.put((path, line if line.endswith("\n") else line + "\n"))
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Blocks until every queued line has been written or timeout expires.
+
+        Returns False if lines were still pending when the timeout expired.
+        """
+        with self._queue.all_tasks_done:
+            return self._queue.all_tasks_done.wait_for(lambda: not self._queue.unfinished_tasks, timeout)
+
+    def _run(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            try:
+                by_path: dict[str, list[str]] = {}
+                for path, line in batch:
+                    by_path.setdefault(path, []).append(line)
+                for path, lines in by_path.items():
+                    try:
+                        with open(
+                            path, "a", encoding="utf-8", errors="replace", buffering=_HISTORY_WRITE_BUFFER
+                        ) as f:
+                            f.writelines(lines)
+                    except Exception:
+                        # A bad file or line must never kill the writer thread
+                        pass
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+_HISTORY_WRITER = _HistoryWriter()
+
+def commit_history() -> None:
+    """Flushes pending history writes, called on shutdown."""
+    _HISTORY_WRITER.flush(_HISTORY_COMMIT_TIMEOUT)
+
+atexit.register(commit_history)
+
+@mcp.tool()
+def refresh_env() -> str:
+    """Re-detects the shell type and history file after SHELL or HISTFILE changed."""
+    global _HOME, _SHELL, _DEFAULT_HISTFILE
+    _HOME, _SHELL, _DEFAULT_HISTFILE = _detect_shell()
+    return f"Shell: {_SHELL}\nHistory file: {_DEFAULT_HISTFILE or 'not found'}"
+
+@mcp.tool()
+def capture_terminal_state(lines: int = 10) -> ShellHistory:
+    """Detects shell type and reads the last lines of history."""
+    hist_file = _DEFAULT_HISTFILE
+
     history = []
     if hist_file and os.path.exists(hist_file):
+        # Make sure our own pending writes are visible before reading
+        _HISTORY_WRITER.flush(_HISTORY_FLUSH_TIMEOUT)
         try:
-            # Read last lines. Zsh history has some binary data sometimes, using errors='replace'
-            with open(hist_file, "r", encoding="utf-8", errors="replace") as f:
-                history = f.readlines()[-lines:]
+            with open(hist_file, "rb") as f:
+                tail = _tail_lines(f, lines, _HISTORY_BLOCK_SIZE)
+            # Zsh history has some binary data sometimes, using errors='replace'
+            history = tail.decode("utf-8", errors="replace").split("\n") if tail else []
         except Exception as e:
             history = [f"Error reading history: {str(e)}"]
     else:
         history = ["History file not found or HISTFILE not set."]
 
-    return f"Shell: {shell}\nLast {len(history)} lines of history:\n" + "".join(history)
+    return ShellHistory(shell=_SHELL, history=history)
 
-@mcp.tool()
-def introspect_runtime() -> str:
-    """Returns a Health Report of the current directory and runtime environment."""
-    report = []
-    
-    # Python info
+async def _spawn(cmd: tuple[str, ...]) -> asyncio.subprocess.Process:
+    # Each probe gets its own process group so wrapper scripts and version
+    # manager shims can be signalled together with their children
+    return await asyncio.create_subprocess_exec(
+        *cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, env=_MIN_ENV, start_new_session=True
+    )
+
+def _signal_group(proc: asyncio.subprocess.Process, sig: int) -> None:
+    with contextlib.suppress(ProcessLookupError, PermissionError):
+        os.killpg(proc.pid, sig)
+
+def _close_stdout(proc: asyncio.subprocess.Process) -> None:
+    """Closes our end of proc's stdout pipe.
+
+    asyncio's wait() only returns once every pipe is closed, which a
+    grandchild holding stdout would otherwise delay indefinitely.
+    """
+    transport = proc._transport.get_pipe_transport(1)
+    if transport is not None:
+        transport.close()
+
+async def _bounded(proc: asyncio.subprocess.Process, cmd: tuple[str, ...], aw: Awaitable[Any]) -> Any:
+    """Awaits aw, killing proc's process group and raising TimeoutExpired if it takes too long."""
     try:
-        python_path = subprocess.check_output(["which", "python3"], text=True).strip()
-        python_version = subprocess.check_output(["python3", "--version"], text=True).strip()
-        report.append(f"Python: {python_version} at {python_path}")
-    except:
-        report.append("Python: Not found")
-    
+        return await asyncio.wait_for(aw, _SUBPROCESS_TIMEOUT)
+    except TimeoutError:
+        _signal_group(proc, signal.SIGKILL)
+        _close_stdout(proc)
+        with contextlib.suppress(TimeoutError):
+            await asyncio.wait_for(proc.wait(), _SUBPROCESS_REAP_TIMEOUT)
+        raise subprocess.TimeoutExpired(cmd, _SUBPROCESS_TIMEOUT)
+
+async def _check_output(*cmd: str) -> str:
+    """Async equivalent of subprocess.check_output(cmd, text=True)."""
+    proc = await _spawn(cmd)
+    stdout, _ = await _bounded(proc, cmd, proc.communicate())
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd, stdout)
+    return stdout.decode("utf-8", errors="replace")
+
+async def _head_output(*cmd: str, start: int, stop: int) -> List[str]:
+    """Returns stdout lines [start:stop] of cmd, terminating it once they are read."""
+    proc = await _spawn(cmd)
+
+    async def read() -> List[str]:
+        lines = []
+        for _ in range(stop):
+            line = await proc.stdout.readline()
+            if not line:
+                break
+            lines.append(line.decode("utf-8", errors="replace").rstrip("\n"))
+        else:
+            # Got everything we need, the rest of the listing is never buffered.
+            # Closing the pipe first lets writers that ignore SIGTERM die of SIGPIPE
+            _close_stdout(proc)
+            _signal_group(proc, signal.SIGTERM)
+            await proc.wait()
+            return lines[start:]
+
+        if await proc.wait() != 0:
+            raise subprocess.CalledProcessError(proc.returncode, cmd)
+        return lines[start:]
+
+    return await _bounded(proc, cmd, read())
+
+@functools.lru_cache(maxsize=32)
+def _which(name: str, path: str) -> Optional[str]:
+    # PATH is part of the key so changing it invalidates the lookup
+    return shutil.which(name, path=path)
+
+def _pip_packages() -> List[str]:
+    # Reads the same *.dist-info metadata pip list would, without spawning pip
+    names = {d.metadata["Name"] for d in importlib.metadata.distributions()}
+    names.discard(None)
+    return sorted(names, key=str.lower)
+
+async def _pip_info() -> List[str]:
     # Pip list (limited to first 20 for brevity)
     try:
-        pip_list = subprocess.check_output(["pip", "list"], text=True).splitlines()[2:22]
-        report.append("Pip Packages (partial): " + ", ".join([p.split()[0] for p in pip_list]))
-    except:
-        report.append("Pip: Failed to list packages")
+        return (await asyncio.to_thread(_pip_packages))[:20]
+    except Exception:
+        return []
+
+async def _node_info() -> tuple[Optional[str], List[str]]:
+    """Returns the node version and a partial npm listing, None/[] when unavailable."""
+    node_version, npm_list = await asyncio.gather(
+        _check_output("node", "--version"),
+        _head_output("npm", "list", "--depth=0", start=1, stop=10),
+        return_exceptions=True,
+    )
+    if isinstance(node_version, BaseException):
+        return None, []
+    if isinstance(npm_list, BaseException):
+        return node_version.strip(), []
+    return node_version.strip(), [line for line in npm_list if line.strip()]
 
-    # Node info
+def _mtime_ns(path: str) -> int:
     try:
-        node_version = subprocess.check_output(["node", "--version"], text=True).strip()
-        report.append(f"Node: {node_version}")
-        npm_list = subprocess.check_output(["npm", "list", "--depth=0"], text=True).splitlines()[1:10]
-        report.append("NPM Packages (partial): " + ", ".join(npm_list))
-    except:
-        report.append("Node/NPM: Not found or failed to list")
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return 0
+
+def _npm_prefix(cwd: str) -> str:
+    """Returns the project directory npm list reports on for cwd.
+
+    Like npm, this is the nearest ancestor containing a package.json or
+    node_modules, falling back to cwd itself.
+    """
+    directory = cwd
+    while True:
+        if os.path.exists(os.path.join(directory, "package.json")) or os.path.isdir(
+            os.path.join(directory, "node_modules")
+        ):
+            return directory
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            return cwd
+        directory = parent
 
-    # Local config files
-    files = os.listdir(".")
-    config_files = [f for f in files if f in [".env", "pyproject.toml", "package.json", "requirements.txt", "uv.lock"]]
-    report.append(f"Current Directory: {os.getcwd()}")
-    report.append(f"Config Files: {', '.join(config_files)}")
+def _node_stamp(cwd: str) -> str:
+    """Identifies the inputs of _node_info: the resolved node/npm binaries and the npm project.
 
-    return "\n".join(report)
+    The binaries are included so switching node versions (e.g. via PATH) is
+    never answered from a stale entry.
+    """
+    path = _MIN_ENV.get("PATH", os.defpath)
+    parts = []
+    for name in ("node", "npm"):
+        binary = _which(name, path)
+        parts.append(f"{binary}@{_mtime_ns(binary) if binary else 0}")
+    prefix = _npm_prefix(cwd)
+    parts.append(prefix)
+    for name in ("node_modules", "package.json"):
+        parts.append(str(_mtime_ns(os.path.join(prefix, name))))
+    return ":".join(parts)
+
+def _disk_cache_path() -> str:
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(_HOME, ".cache")
+    return os.path.join(base, "envmcp", "introspect.json")
+
+@contextlib.contextmanager
+def _file_lock(path: str):
+    """Holds an exclusive flock on path for multi-server safety, where supported."""
+    with open(path, "a") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+def _load_disk_cache(path: str) -> dict:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return data if isinstance(data, dict) else {}
+
+def _disk_get(slot: str, stamp: str) -> Optional[list]:
+    """Returns [value] if the persisted entry for slot was stored under stamp
+    less than _DISK_CACHE_MAX_AGE seconds ago, else None."""
+    entry = _load_disk_cache(_disk_cache_path()).get(slot)
+    if not (isinstance(entry, list) and len(entry) == 3 and entry[0] == stamp):
+        return None
+    if not isinstance(entry[1], (int, float)) or not 0 <= time.time() - entry[1] < _DISK_CACHE_MAX_AGE:
+        return None
+    return [entry[2]]
+
+def _disk_put(slot: str, stamp: str, value: Any) -> None:
+    """Stores value for slot, keeping only the latest stamp per slot."""
+    path = _disk_cache_path()
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with _file_lock(path + ".lock"):
+            data = _load_disk_cache(path)
+            data[slot] = [stamp, time.time(), value]
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+            try:
+                with os.fdopen(fd, "w", encoding="utf-8") as f:
+                    json.dump(data, f)
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+    except OSError:
+        # The persistent cache is best effort only
+        pass
+
+async def _persisted(
+    slot: str,
+    stamp: str,
+    fn: Callable[[], Awaitable[Any]],
+    keep: Callable[[Any], bool],
+    read: bool = True,
+) -> Any:
+    """Returns the on-disk result of fn for slot if it was stored under stamp, else recomputes it.
+
+    This lets a freshly started server skip the slow probes when nothing changed.
+    Only results accepted by keep are written, so a transient failure is never
+    persisted. Pass read=False to skip the lookup and always recompute.
+    """
+    if read:
+        hit = _disk_get(slot, stamp)
+        if hit is not None:
+            return hit[0]
+    value = await fn()
+    if keep(value):
+        _disk_put(slot, stamp, value)
+    return value
+
+async def _memo(slot: str, stamp: str, ttl: float, fn: Callable[[], Awaitable[Any]], refresh: bool = False) -> Any:
+    """Returns the cached result of fn for slot if it is younger than ttl seconds
+    and was stored under stamp, else recomputes it.
+
+    Each slot holds a single entry, so a changed stamp replaces the old result.
+    """
+    now = time.monotonic()
+    cached = _CACHE.get(slot)
+    if not refresh and cached is not None and cached[1] == stamp and now - cached[0] < ttl:
+        return cached[2]
+    value = await fn()
+    _CACHE[slot] = (now, stamp, value)
+    return value
+
+@mcp.tool()
+async def introspect_runtime(refresh: bool = False) -> RuntimeHealth:
+    """Returns a Health Report of the current directory and runtime environment.
+
+    Results are cached briefly; pass refresh=True to force the probes to run again.
+    """
+    cwd = os.getcwd()
+
+    # Package listings are keyed on the directories they read so installs
+    # invalidate the cache immediately. importlib.metadata scans every
+    # sys.path entry, and is cheap enough that it is never persisted
+    pip_slot = f"pip:{sys.executable}"
+    pip_stamp = ":".join(str(_mtime_ns(entry or cwd)) for entry in sys.path)
+    node_slot = f"node:{cwd}"
+    node_stamp = _node_stamp(cwd)
+
+    # Run the probes at once. The disk cache is only consulted the first time
+    # a slot is probed in this process; after that the in-memory TTL applies
+    pip_packages, (node_version, npm_packages) = await asyncio.gather(
+        _memo(pip_slot, pip_stamp, _CACHE_TTL, _pip_info, refresh),
+        _memo(node_slot, node_stamp, _CACHE_TTL,
+              lambda: _persisted(node_slot, node_stamp, _node_info, lambda v: v[0] is not None and bool(v[1]),
+                                 read=not refresh and node_slot not in _CACHE), refresh),
+    )
+
+    return RuntimeHealth(
+        python_version=_PYTHON_VERSION,
+        python_executable=sys.executable,
+        # The python3 a user would get on PATH, which may differ from the server's interpreter
+        path_python=_which("python3", os.environ.get("PATH", os.defpath)),
+        pip_packages=pip_packages,
+        node_version=node_version,
+        npm_packages=npm_packages,
+        current_directory=cwd,
+        # Local config files
+        env_files=[name for name in _CONFIG_NAMES if os.path.isfile(os.path.join(cwd, name))],
+    )
+
+@functools.lru_cache(maxsize=256)
+def _tokenize(command: str) -> tuple[str, ...]:
+    # Agents often retry the exact same command, so keep recent tokenizations around
+    return tuple(shlex.split(command, posix=True))
 
 @mcp.tool()
 def secure_shell_executor(command: str, dry_run: bool = True) -> str:
@@ -93,14 +497,12 @@ def secure_shell_executor(command: str, dry_run: bool = True) -> str:
         return f"[DRY RUN] Would execute: {command}"
     
     try:
-        # Basic validation to prevent some obvious disasters
-        forbidden = [";", "&&", "||", "|", ">", "<", "`", "$("]
         # This is a very basic check, normally you'd want something more robust
         # But we are in a controlled agent environment.
-        if any(char in command for char in forbidden):
+        if _FORBIDDEN_RE.search(command):
              return f"Command blocked due to detected shell metacharacters: {command}"
         
-        result = subprocess.run(command.split(), capture_output=True, text=True, timeout=30)
+        result = subprocess.run(list(_tokenize(command)), capture_output=True, text=True, timeout=30)
         if result.returncode == 0:
             return f"Success:\n{result.stdout}"
         else:
@@ -123,34 +525,9 @@ def read_error_file(file_path: str, max_lines: int = 100) -> str:
         if not os.path.isfile(file_path):
             return f"Error: Path {file_path} is not a file."
 
-        size = os.path.getsize(file_path)
-        
         with open(file_path, "rb") as f:
-            # If file is relatively small (under 1MB), read fully
-            if size < 1024 * 1024: 
-                content = f.read().decode('utf-8', errors='replace')
-                lines = content.splitlines()
-                # If we still want to respect max_lines
-                if len(lines) > max_lines:
-                     return "\n".join(lines[-max_lines:])
-                return content
-            
-            # If large, seek to end and read backwards approximately
-            # Estimate 100 bytes per line to be safe
-            read_size = max_lines * 200 
-            f.seek(0, os.SEEK_END)
-            file_end = f.tell()
-            f.seek(max(0, file_end - read_size))
-            
-            content = f.read().decode('utf-8', errors='replace')
-            lines = content.splitlines()
-            
-            # The first line might be partial because of the seek, so drop it if we didn't read from start
-            if file_end > read_size and len(lines) > 0:
-                lines = lines[1:]
-                
-            return "\n".join(lines[-max_lines:])
-            
+            return _tail_lines(f, max_lines).decode("utf-8", errors="replace")
+
     except Exception as e:
         return f"Failed to read file: {str(e)}"
 